@@ -1,14 +1,35 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import hmac
 import httpx
+import jwt
+import orjson
 import os
-from typing import Dict
+import time
+from typing import Dict, Optional
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: один клиент с пулом keep-alive соединений на весь процесс
+    app.state.http = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200)
+    )
+    yield
+    # Shutdown
+    await app.state.http.aclose()
 
 app = FastAPI(
     title="EcoFlow API Gateway",
     description="Микросервисная платформа для управления экологическими проектами",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 security = HTTPBearer()
@@ -21,6 +42,18 @@ SERVICES = {
     "monitoring": os.getenv("MONITORING_SERVICE_URL", "http://monitoring-service:8004"),
 }
 
+# Ключ для проверки JWT, общий с auth-service
+SECRET_KEY = os.getenv("SECRET_KEY", "ecoflow-secret-key")
+ALGORITHM = "HS256"
+
+# Ключ для подписи внутренних запросов к сервисам
+INTERNAL_SECRET = os.getenv("INTERNAL_SECRET", "ecoflow-internal-secret").encode()
+
+# Кэш агрегированного статуса /health
+HEALTH_CACHE_TTL = 1.5  # секунд
+_health_cache_ts: float = 0.0
+_health_cache_data: Optional[Dict[str, str]] = None
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -30,19 +63,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Общий HTTP клиент, созданный в lifespan"""
+    return request.app.state.http
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Проверка JWT токена"""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{SERVICES['auth']}/verify",
-                headers={"Authorization": f"Bearer {credentials.credentials}"}
-            )
-            if response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Invalid token")
-            return response.json()
-        except:
-            raise HTTPException(status_code=503, detail="Auth service unavailable")
+    """Проверка JWT токена локально, без запроса в auth-service"""
+    try:
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        return {"user_id": payload["user_id"], "email": payload["sub"]}
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+def internal_auth_headers(user_id: int) -> Dict[str, str]:
+    """Заголовки с подписью gateway для запросов к сервисам от имени пользователя"""
+    ts = str(int(time.time()))
+    signature = hmac.new(INTERNAL_SECRET, f"{user_id}:{ts}".encode(), hashlib.sha256).hexdigest()
+    return {"X-User-Id": str(user_id), "X-Ts": ts, "X-Internal-Auth": signature}
+
+def forward_response(response: httpx.Response) -> Response:
+    """Отдает ответ сервиса как есть, без разбора и повторной сериализации"""
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type", "application/json")
+    )
 
 @app.get("/")
 async def root():
@@ -53,46 +100,119 @@ async def root():
     }
 
 @app.get("/health")
-async def health_check():
+async def health_check(client: httpx.AsyncClient = Depends(get_http_client)):
     """Проверка здоровья всех сервисов"""
+    global _health_cache_ts, _health_cache_data
+    now = time.monotonic()
+    if _health_cache_data is not None and now - _health_cache_ts < HEALTH_CACHE_TTL:
+        return _health_cache_data
+    
     health_status = {"gateway": "healthy"}
     
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        for service_name, url in SERVICES.items():
-            try:
-                response = await client.get(f"{url}/health")
-                health_status[service_name] = "healthy" if response.status_code == 200 else "unhealthy"
-            except:
-                health_status[service_name] = "unreachable"
+    # Опрашиваем все сервисы параллельно
+    responses = await asyncio.gather(
+        *[client.get(f"{url}/health") for url in SERVICES.values()],
+        return_exceptions=True
+    )
+    for service_name, response in zip(SERVICES.keys(), responses):
+        if isinstance(response, BaseException):
+            health_status[service_name] = "unreachable"
+        else:
+            health_status[service_name] = "healthy" if response.status_code == 200 else "unhealthy"
     
+    _health_cache_ts = time.monotonic()
+    _health_cache_data = health_status
     return health_status
 
 @app.post("/api/projects")
 async def create_project(
     project_data: Dict,
-    user_data: Dict = Depends(verify_token)
+    user_data: Dict = Depends(verify_token),
+    client: httpx.AsyncClient = Depends(get_http_client)
 ):
     """Создание нового экологического проекта"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{SERVICES['projects']}/projects",
-            json={**project_data, "created_by": user_data["user_id"]},
-            headers={"X-User-Id": str(user_data["user_id"])}
-        )
-        return response.json()
+    response = await client.post(
+        f"{SERVICES['projects']}/projects",
+        json={**project_data, "created_by": user_data["user_id"]},
+        headers=internal_auth_headers(user_data["user_id"])
+    )
+    return forward_response(response)
+
+@app.patch("/api/projects/{project_id}/progress")
+async def update_project_progress(
+    project_id: int,
+    progress: float,
+    user_data: Dict = Depends(verify_token),
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    """Обновление прогресса проекта участником"""
+    response = await client.patch(
+        f"{SERVICES['projects']}/projects/{project_id}/progress",
+        params={"progress": progress},
+        headers=internal_auth_headers(user_data["user_id"])
+    )
+    return forward_response(response)
+
+@app.post("/api/emissions")
+async def record_emission(
+    emission_data: Dict,
+    user_data: Dict = Depends(verify_token),
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    """Запись выбросов текущего пользователя"""
+    response = await client.post(
+        f"{SERVICES['carbon']}/emissions",
+        json={**emission_data, "user_id": user_data["user_id"]},
+        headers=internal_auth_headers(user_data["user_id"])
+    )
+    return forward_response(response)
+
+@app.post("/api/offset")
+async def record_offset(
+    offset_data: Dict,
+    user_data: Dict = Depends(verify_token),
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    """Запись компенсации выбросов текущего пользователя"""
+    response = await client.post(
+        f"{SERVICES['carbon']}/offset",
+        json={**offset_data, "user_id": user_data["user_id"]},
+        headers=internal_auth_headers(user_data["user_id"])
+    )
+    return forward_response(response)
+
+@app.get("/api/recommendations")
+async def get_recommendations(
+    user_data: Dict = Depends(verify_token),
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    """Рекомендации по снижению углеродного следа для текущего пользователя"""
+    response = await client.get(
+        f"{SERVICES['carbon']}/recommendations/{user_data['user_id']}",
+        headers=internal_auth_headers(user_data["user_id"])
+    )
+    return forward_response(response)
 
 @app.get("/api/dashboard")
-async def get_dashboard(user_data: Dict = Depends(verify_token)):
+async def get_dashboard(
+    user_data: Dict = Depends(verify_token),
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
     """Получение данных для dashboard"""
-    async with httpx.AsyncClient() as client:
-        projects_response = await client.get(
-            f"{SERVICES['projects']}/projects/user/{user_data['user_id']}"
-        )
-        carbon_response = await client.get(
-            f"{SERVICES['carbon']}/footprint/{user_data['user_id']}"
-        )
-        
-        return {
-            "projects": projects_response.json(),
-            "carbon_footprint": carbon_response.json()
-        }
+    headers = internal_auth_headers(user_data["user_id"])
+    
+    # Запросы независимы, выполняем их параллельно
+    projects_response, carbon_response = await asyncio.gather(
+        client.get(f"{SERVICES['projects']}/projects/user/{user_data['user_id']}", headers=headers),
+        client.get(f"{SERVICES['carbon']}/footprint/{user_data['user_id']}", headers=headers)
+    )
+    
+    for service_name, response in (("projects", projects_response), ("carbon", carbon_response)):
+        if response.status_code != 200:
+            raise HTTPException(status_code=502, detail=f"{service_name} service error")
+    
+    # Явный ORJSONResponse: для dict FastAPI прогнал бы jsonable_encoder по всему ответу
+    return ORJSONResponse({
+        "projects": orjson.loads(projects_response.content),
+        "carbon_footprint": orjson.loads(carbon_response.content)
+    })
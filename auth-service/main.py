@@ -1,18 +1,25 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, EmailStr
 from datetime import datetime, timedelta
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import asyncio
 import jwt
-from passlib.context import CryptContext
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+import bcrypt
 import databases
 import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="EcoFlow Auth Service")
+app = FastAPI(title="EcoFlow Auth Service", default_response_class=ORJSONResponse)
 
 # Настройки
 SECRET_KEY = os.getenv("SECRET_KEY", "ecoflow-secret-key")
@@ -38,10 +45,35 @@ users = sqlalchemy.Table(
 )
 
 engine = sqlalchemy.create_engine(DATABASE_URL)
+
+if engine.dialect.name == "sqlite":
+    # WAL: читатели не блокируются записью; режим сохраняется в файле БД
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
 metadata.create_all(engine)
 
-# Хэширование паролей
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# INSERT ... ON CONFLICT для текущей СУБД
+upsert_factory = postgresql.insert if database.url.dialect == "postgresql" else sqlite.insert
+
+# Запросы, собранные один раз; значения подставляются через .params()
+USER_BY_EMAIL_QUERY = users.select().where(users.c.email == sqlalchemy.bindparam("email"))
+USER_BY_ID_QUERY = users.select().where(users.c.id == sqlalchemy.bindparam("id"))
+
+# Кэш профилей для GET /users/{user_id}; при изменении полей профиля запись нужно удалять
+USER_CACHE_TTL = 60  # секунд
+_user_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL)
+
+# Хэширование паролей: argon2id, bcrypt оставлен для проверки старых хэшей
+password_hasher = PasswordHasher(
+    time_cost=3,
+    memory_cost=65536,  # КиБ
+    parallelism=4
+)
+BCRYPT_PREFIX = "$2"
 
 # Модели
 class UserCreate(BaseModel):
@@ -62,20 +94,42 @@ class Token(BaseModel):
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    # Пул потоков для хэширования паролей, чтобы не блокировать event loop
+    app.state.hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
 
 @app.on_event("shutdown")
 async def shutdown():
     await database.disconnect()
+    app.state.hash_executor.shutdown(wait=False)
 
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "auth-service"}
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    if hashed_password.startswith(BCRYPT_PREFIX):
+        # bcrypt учитывает только первые 72 байта, как и passlib раньше
+        try:
+            return bcrypt.checkpw(plain_password.encode()[:72], hashed_password.encode())
+        except ValueError:
+            return False
+    try:
+        return password_hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
+
+def password_needs_rehash(hashed_password):
+    return (
+        hashed_password.startswith(BCRYPT_PREFIX)
+        or password_hasher.check_needs_rehash(hashed_password)
+    )
+
+async def run_in_hash_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.hash_executor, func, *args)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -89,22 +143,25 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 @app.post("/register", response_model=Token)
 async def register(user: UserCreate):
-    # Проверка существования пользователя
-    query = users.select().where(users.c.email == user.email)
-    existing_user = await database.fetch_one(query)
+    # Создание пользователя одним запросом: при занятом email строка не вставляется
+    hashed_password = await run_in_hash_executor(get_password_hash, user.password)
+    query = (
+        upsert_factory(users)
+        .values(
+            email=user.email,
+            username=user.username,
+            hashed_password=hashed_password,
+            organization=user.organization
+        )
+        .on_conflict_do_nothing(index_elements=["email"])
+        .returning(users.c.id)
+    )
+    row = await database.fetch_one(query)
     
-    if existing_user:
+    if row is None:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # Создание пользователя
-    hashed_password = get_password_hash(user.password)
-    query = users.insert().values(
-        email=user.email,
-        username=user.username,
-        hashed_password=hashed_password,
-        organization=user.organization
-    )
-    user_id = await database.execute(query)
+    user_id = row.id
     
     # Создание токена
     access_token = create_access_token(
@@ -119,15 +176,26 @@ async def register(user: UserCreate):
 
 @app.post("/login", response_model=Token)
 async def login(credentials: UserLogin):
-    query = users.select().where(users.c.email == credentials.email)
-    user = await database.fetch_one(query)
+    user = await database.fetch_one(USER_BY_EMAIL_QUERY.params(email=credentials.email))
     
-    if not user or not verify_password(credentials.password, user.hashed_password):
+    if not user or not await run_in_hash_executor(
+        verify_password, credentials.password, user.hashed_password
+    ):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     
+    # Перехэшируем пароль, если хэш создан устаревшей схемой или параметрами
+    if password_needs_rehash(user.hashed_password):
+        hashed_password = await run_in_hash_executor(get_password_hash, credentials.password)
+        query = (
+            users.update()
+            .where(users.c.id == user.id)
+            .values(hashed_password=hashed_password)
+        )
+        await database.execute(query)
+    
     access_token = create_access_token(
         data={"sub": user.email, "user_id": user.id}
     )
@@ -150,16 +218,21 @@ async def verify_token(token: str):
 
 @app.get("/users/{user_id}")
 async def get_user(user_id: int):
-    query = users.select().where(users.c.id == user_id)
-    user = await database.fetch_one(query)
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    
+    user = await database.fetch_one(USER_BY_ID_QUERY.params(id=user_id))
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return {
+    user_data = {
         "id": user.id,
         "email": user.email,
         "username": user.username,
         "organization": user.organization,
         "created_at": user.created_at
     }
+    _user_cache[user_id] = user_data
+    return user_data
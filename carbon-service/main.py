@@ -1,12 +1,38 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from typing import List
 from datetime import datetime, date
+import asyncio
 import databases
 import sqlalchemy
+import hashlib
+import hmac
 import os
+import time
 
-app = FastAPI(title="EcoFlow Carbon Service")
+app = FastAPI(title="EcoFlow Carbon Service", default_response_class=ORJSONResponse)
+
+# Проверка подписи внутренних запросов от api-gateway
+INTERNAL_SECRET = os.getenv("INTERNAL_SECRET", "ecoflow-internal-secret").encode()
+INTERNAL_AUTH_MAX_AGE = 30  # секунд
+
+async def verify_internal_auth(
+    x_user_id: int = Header(...),
+    x_ts: int = Header(...),
+    x_internal_auth: str = Header(...)
+) -> int:
+    """Проверка подписи gateway, возвращает id пользователя"""
+    if abs(time.time() - x_ts) > INTERNAL_AUTH_MAX_AGE:
+        raise HTTPException(status_code=401, detail="Internal auth expired")
+    expected = hmac.new(INTERNAL_SECRET, f"{x_user_id}:{x_ts}".encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, x_internal_auth):
+        raise HTTPException(status_code=401, detail="Invalid internal auth")
+    return x_user_id
+
+def check_user_access(user_id: int, x_user_id: int):
+    if user_id != x_user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./carbon.db")
 database = databases.Database(DATABASE_URL)
@@ -23,6 +49,7 @@ carbon_footprint = sqlalchemy.Table(
     sqlalchemy.Column("emissions", sqlalchemy.Float),  # кг CO2
     sqlalchemy.Column("description", sqlalchemy.String(200)),
     sqlalchemy.Column("created_at", sqlalchemy.DateTime, default=datetime.utcnow),
+    sqlalchemy.Index("ix_cf_user_date", "user_id", "date"),
 )
 
 # Таблица компенсаций
@@ -35,11 +62,112 @@ carbon_offset = sqlalchemy.Table(
     sqlalchemy.Column("amount", sqlalchemy.Float),  # компенсировано CO2 в кг
     sqlalchemy.Column("date", sqlalchemy.Date, default=date.today),
     sqlalchemy.Column("created_at", sqlalchemy.DateTime, default=datetime.utcnow),
+    sqlalchemy.Index("ix_co_user_date", "user_id", "date"),
 )
 
 engine = sqlalchemy.create_engine(DATABASE_URL)
+
+if engine.dialect.name == "sqlite":
+    # WAL: читатели не блокируются записью; режим сохраняется в файле БД
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
 metadata.create_all(engine)
 
+# create_all пропускает существующие таблицы вместе с их индексами,
+# поэтому индексы досоздаем отдельно для уже существующих БД
+for table in metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+# Запросы, собранные один раз; значения подставляются через .params()
+# Выбросы по категориям за последние периоды
+EMISSIONS_BY_MONTH_QUERY = sqlalchemy.text("""
+    SELECT 
+        category,
+        SUM(emissions) as total_emissions,
+        substr(date, 1, 7) as month
+    FROM carbon_footprint
+    WHERE user_id = :user_id
+    GROUP BY category, substr(date, 1, 7)
+    ORDER BY month DESC
+    LIMIT 6
+""")
+
+EMISSIONS_BY_DAY_QUERY = sqlalchemy.text("""
+    SELECT 
+        category,
+        SUM(emissions) as total_emissions,
+        date(date) as day
+    FROM carbon_footprint
+    WHERE user_id = :user_id
+    GROUP BY category, date(date)
+    ORDER BY day DESC
+    LIMIT 30
+""")
+
+# Компенсации
+OFFSETS_BY_DAY_QUERY = sqlalchemy.text("""
+    SELECT 
+        SUM(amount) as total_offset,
+        date
+    FROM carbon_offset
+    WHERE user_id = :user_id
+    GROUP BY date
+    ORDER BY date DESC
+    LIMIT 30
+""")
+
+# Итоги по всем записям пользователя, без группировки и лимитов
+FOOTPRINT_TOTALS_QUERY = sqlalchemy.text("""
+    SELECT
+        e.total_emissions,
+        o.total_offset,
+        e.total_emissions - o.total_offset as net_footprint
+    FROM
+        (SELECT COALESCE(SUM(emissions), 0) as total_emissions
+         FROM carbon_footprint WHERE user_id = :user_id) e,
+        (SELECT COALESCE(SUM(amount), 0) as total_offset
+         FROM carbon_offset WHERE user_id = :user_id) o
+""")
+
+TOP_CATEGORIES_QUERY = sqlalchemy.text("""
+    SELECT 
+        category,
+        SUM(emissions) as emissions,
+        COUNT(*) as records
+    FROM carbon_footprint
+    WHERE user_id = :user_id
+    GROUP BY category
+    ORDER BY emissions DESC
+    LIMIT 3
+""")
+
+# Рекомендации по категориям выбросов
+RECOMMENDATIONS = {
+    "transport": {
+        "category": "transport",
+        "suggestion": "Используйте общественный транспорт или велосипед 2 раза в неделю",
+        "potential_reduction": 50,  # кг CO2 в месяц
+        "priority": "high"
+    },
+    "energy": {
+        "category": "energy",
+        "suggestion": "Замените лампы на светодиодные",
+        "potential_reduction": 20,
+        "priority": "medium"
+    },
+    "food": {
+        "category": "food",
+        "suggestion": "Уменьшите потребление мяса на 30%",
+        "potential_reduction": 100,
+        "priority": "high"
+    },
+}
+
 # Модели
 class EmissionRecord(BaseModel):
     user_id: int
@@ -67,119 +195,60 @@ async def health():
     return {"status": "healthy", "service": "carbon-service"}
 
 @app.post("/emissions")
-async def record_emission(emission: EmissionRecord):
+async def record_emission(emission: EmissionRecord, x_user_id: int = Depends(verify_internal_auth)):
+    check_user_access(emission.user_id, x_user_id)
     query = carbon_footprint.insert().values(**emission.dict())
     record_id = await database.execute(query)
     return {"id": record_id, "message": "Emission recorded successfully"}
 
 @app.post("/offset")
-async def record_offset(offset: OffsetRecord):
+async def record_offset(offset: OffsetRecord, x_user_id: int = Depends(verify_internal_auth)):
+    check_user_access(offset.user_id, x_user_id)
     query = carbon_offset.insert().values(**offset.dict())
     record_id = await database.execute(query)
     return {"id": record_id, "message": "Offset recorded successfully"}
 
 @app.get("/footprint/{user_id}")
-async def get_carbon_footprint(user_id: int, period: str = "month"):
+async def get_carbon_footprint(
+    user_id: int,
+    period: str = "month",
+    x_user_id: int = Depends(verify_internal_auth)
+):
     """Получение углеродного следа пользователя"""
+    check_user_access(user_id, x_user_id)
     
-    # Общие выбросы
     if period == "month":
-        query = sqlalchemy.text("""
-            SELECT 
-                category,
-                SUM(emissions) as total_emissions,
-                strftime('%Y-%m', date) as month
-            FROM carbon_footprint
-            WHERE user_id = :user_id
-            GROUP BY category, strftime('%Y-%m', date)
-            ORDER BY month DESC
-            LIMIT 6
-        """)
+        query = EMISSIONS_BY_MONTH_QUERY
     else:
-        query = sqlalchemy.text("""
-            SELECT 
-                category,
-                SUM(emissions) as total_emissions,
-                date(date) as day
-            FROM carbon_footprint
-            WHERE user_id = :user_id
-            GROUP BY category, date(date)
-            ORDER BY day DESC
-            LIMIT 30
-        """)
+        query = EMISSIONS_BY_DAY_QUERY
     
-    emissions = await database.fetch_all(query, values={"user_id": user_id})
-    
-    # Компенсации
-    offset_query = sqlalchemy.text("""
-        SELECT 
-            SUM(amount) as total_offset,
-            date
-        FROM carbon_offset
-        WHERE user_id = :user_id
-        GROUP BY date
-        ORDER BY date DESC
-        LIMIT 30
-    """)
-    
-    offsets = await database.fetch_all(offset_query, values={"user_id": user_id})
-    
-    # Расчет чистого следа
-    total_emissions = sum([e.total_emissions for e in emissions])
-    total_offset = sum([o.total_offset for o in offsets]) if offsets else 0
-    net_footprint = total_emissions - total_offset
+    # Запросы независимы, выполняем их параллельно
+    emissions, offsets, totals = await asyncio.gather(
+        database.fetch_all(query.params(user_id=user_id)),
+        database.fetch_all(OFFSETS_BY_DAY_QUERY.params(user_id=user_id)),
+        database.fetch_one(FOOTPRINT_TOTALS_QUERY.params(user_id=user_id))
+    )
     
     return {
-        "total_emissions": total_emissions,
-        "total_offset": total_offset,
-        "net_footprint": net_footprint,
+        "total_emissions": totals.total_emissions,
+        "total_offset": totals.total_offset,
+        "net_footprint": totals.net_footprint,
         "emissions_by_category": emissions,
         "offsets": offsets
     }
 
 @app.get("/recommendations/{user_id}")
-async def get_recommendations(user_id: int):
+async def get_recommendations(user_id: int, x_user_id: int = Depends(verify_internal_auth)):
     """Получение рекомендаций по снижению углеродного следа"""
-    query = sqlalchemy.text("""
-        SELECT 
-            category,
-            SUM(emissions) as emissions,
-            COUNT(*) as records
-        FROM carbon_footprint
-        WHERE user_id = :user_id
-        GROUP BY category
-        ORDER BY emissions DESC
-        LIMIT 3
-    """)
-    
-    top_categories = await database.fetch_all(query, values={"user_id": user_id})
+    check_user_access(user_id, x_user_id)
+    top_categories = await database.fetch_all(TOP_CATEGORIES_QUERY.params(user_id=user_id))
     
-    recommendations = []
-    for category in top_categories:
-        if category.category == "transport":
-            recommendations.append({
-                "category": "transport",
-                "suggestion": "Используйте общественный транспорт или велосипед 2 раза в неделю",
-                "potential_reduction": 50,  # кг CO2 в месяц
-                "priority": "high"
-            })
-        elif category.category == "energy":
-            recommendations.append({
-                "category": "energy",
-                "suggestion": "Замените лампы на светодиодные",
-                "potential_reduction": 20,
-                "priority": "medium"
-            })
-        elif category.category == "food":
-            recommendations.append({
-                "category": "food",
-                "suggestion": "Уменьшите потребление мяса на 30%",
-                "potential_reduction": 100,
-                "priority": "high"
-            })
+    recommendations = [
+        RECOMMENDATIONS[c.category] for c in top_categories if c.category in RECOMMENDATIONS
+    ]
     
     return {
         "user_id": user_id,
         "recommendations": recommendations,
-        "total_potential_reduction": sum([r["potential_reduction"] for r in recommendations])
+        "total_potential_reduction": sum(r["potential_reduction"] for r in recommendations)
     }
@@ -1,7 +1,9 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
-from prometheus_client import Counter, Histogram, generate_latest, REGISTRY
+from prometheus_client import Counter, Histogram, generate_latest, REGISTRY, CONTENT_TYPE_LATEST
 from datetime import datetime
+import asyncio
 import databases
 import sqlalchemy
 import os
@@ -30,19 +32,67 @@ ERROR_COUNT = Counter(
     ['method', 'endpoint', 'error_type']
 )
 
+# Пакетная запись логов и метрик
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_INTERVAL = 0.1  # секунд
+
+async def write_batch(table: sqlalchemy.Table, batch: list):
+    try:
+        async with database.transaction():
+            await database.execute_many(table.insert(), batch)
+    except Exception:
+        logger.exception(f"Failed to write {len(batch)} rows to {table.name}")
+
+async def flush_queue(queue: asyncio.Queue, table: sqlalchemy.Table):
+    """Пишет строки из очереди пачками до WRITE_BATCH_SIZE или раз в WRITE_FLUSH_INTERVAL.
+    
+    None в очереди - сигнал остановки: накопленная пачка записывается и задача завершается.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        row = await queue.get()
+        if row is None:
+            return
+        batch = [row]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                await write_batch(table, batch)
+                return
+            batch.append(row)
+        await write_batch(table, batch)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     await database.connect()
+    app.state.log_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    app.state.metric_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    flushers = [
+        asyncio.create_task(flush_queue(app.state.log_queue, service_logs)),
+        asyncio.create_task(flush_queue(app.state.metric_queue, service_metrics)),
+    ]
     logger.info("Monitoring service started")
     yield
-    # Shutdown
+    # Shutdown: дописываем все, что осталось в очередях
+    await app.state.log_queue.put(None)
+    await app.state.metric_queue.put(None)
+    await asyncio.gather(*flushers)
     await database.disconnect()
     logger.info("Monitoring service stopped")
 
 app = FastAPI(
     title="EcoFlow Monitoring Service",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./monitoring.db")
@@ -60,6 +110,7 @@ service_logs = sqlalchemy.Table(
     sqlalchemy.Column("timestamp", sqlalchemy.DateTime, default=datetime.utcnow),
     sqlalchemy.Column("metadata", sqlalchemy.JSON),
 )
+sqlalchemy.Index("ix_logs_ts", service_logs.c.timestamp.desc())
 
 # Таблица метрик
 service_metrics = sqlalchemy.Table(
@@ -71,11 +122,57 @@ service_metrics = sqlalchemy.Table(
     sqlalchemy.Column("metric_value", sqlalchemy.Float),
     sqlalchemy.Column("timestamp", sqlalchemy.DateTime, default=datetime.utcnow),
     sqlalchemy.Column("labels", sqlalchemy.JSON),
+    sqlalchemy.Index("ix_metrics_svc_ts", "service_name", "timestamp"),
 )
 
 engine = sqlalchemy.create_engine(DATABASE_URL)
+
+if engine.dialect.name == "sqlite":
+    # WAL: читатели не блокируются записью; режим сохраняется в файле БД
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
 metadata.create_all(engine)
 
+# create_all пропускает существующие таблицы вместе с их индексами,
+# поэтому индексы досоздаем отдельно для уже существующих БД
+for table in metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+# Запросы, собранные один раз; значения подставляются через .params()
+# Статистика логов за последний час
+LOGS_STATS_QUERY = sqlalchemy.text("""
+    SELECT 
+        service_name,
+        log_level,
+        COUNT(*) as count
+    FROM service_logs
+    WHERE timestamp > datetime('now', '-1 hour')
+    GROUP BY service_name, log_level
+""")
+
+# Метрики за последние 5 минут
+METRICS_STATS_QUERY = sqlalchemy.text("""
+    SELECT 
+        service_name,
+        metric_name,
+        AVG(metric_value) as avg_value,
+        MAX(metric_value) as max_value
+    FROM service_metrics
+    WHERE timestamp > datetime('now', '-5 minutes')
+    GROUP BY service_name, metric_name
+""")
+
+RECENT_LOGS_QUERY = (
+    service_logs.select()
+    .order_by(service_logs.c.timestamp.desc())
+    .limit(sqlalchemy.bindparam("limit"))
+)
+
 @app.get("/health")
 async def health():
     REQUEST_COUNT.labels(method='GET', endpoint='/health', status='200').inc()
@@ -87,76 +184,61 @@ async def health():
 
 @app.post("/log")
 async def log_message(
+    request: Request,
     service_name: str,
     log_level: str,
     message: str,
     metadata: dict = None
 ):
-    query = service_logs.insert().values(
-        service_name=service_name,
-        log_level=log_level,
-        message=message,
-        metadata=metadata or {}
-    )
-    await database.execute(query)
+    await request.app.state.log_queue.put({
+        "service_name": service_name,
+        "log_level": log_level,
+        "message": message,
+        "timestamp": datetime.utcnow(),
+        "metadata": metadata or {}
+    })
     
     # Логируем также в stdout
     logger.info(f"[{service_name}] {log_level}: {message}")
     
-    return {"status": "logged"}
+    return {"status": "queued"}
 
 @app.post("/metric")
 async def record_metric(
+    request: Request,
     service_name: str,
     metric_name: str,
     metric_value: float,
     labels: dict = None
 ):
-    query = service_metrics.insert().values(
-        service_name=service_name,
-        metric_name=metric_name,
-        metric_value=metric_value,
-        labels=labels or {}
-    )
-    await database.execute(query)
+    await request.app.state.metric_queue.put({
+        "service_name": service_name,
+        "metric_name": metric_name,
+        "metric_value": metric_value,
+        "timestamp": datetime.utcnow(),
+        "labels": labels or {}
+    })
     
-    return {"status": "recorded"}
+    return {"status": "queued"}
 
 @app.get("/metrics/prometheus")
 async def prometheus_metrics():
     """Endpoint для Prometheus"""
-    return generate_latest(REGISTRY)
+    # Заголовок задаем напрямую: media_type text/* получил бы второй charset
+    return Response(
+        content=generate_latest(REGISTRY),
+        headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
 
 @app.get("/dashboard")
 async def get_monitoring_dashboard():
     """Панель мониторинга"""
     
     # Статистика логов
-    logs_query = sqlalchemy.text("""
-        SELECT 
-            service_name,
-            log_level,
-            COUNT(*) as count
-        FROM service_logs
-        WHERE timestamp > datetime('now', '-1 hour')
-        GROUP BY service_name, log_level
-    """)
-    
-    logs_stats = await database.fetch_all(logs_query)
+    logs_stats = await database.fetch_all(LOGS_STATS_QUERY)
     
     # Текущие метрики
-    metrics_query = sqlalchemy.text("""
-        SELECT 
-            service_name,
-            metric_name,
-            AVG(metric_value) as avg_value,
-            MAX(metric_value) as max_value
-        FROM service_metrics
-        WHERE timestamp > datetime('now', '-5 minutes')
-        GROUP BY service_name, metric_name
-    """)
-    
-    metrics_stats = await database.fetch_all(metrics_query)
+    metrics_stats = await database.fetch_all(METRICS_STATS_QUERY)
     
     # Статусы сервисов (имитация проверки)
     services_status = {
@@ -176,9 +258,4 @@ async def get_monitoring_dashboard():
 
 @app.get("/logs/recent")
 async def get_recent_logs(limit: int = 100):
-    query = (
-        service_logs.select()
-        .order_by(service_logs.c.timestamp.desc())
-        .limit(limit)
-    )
-    return await database.fetch_all(query)
+    return await database.fetch_all(RECENT_LOGS_QUERY.params(limit=limit))
@@ -1,13 +1,38 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from enum import Enum
 from datetime import datetime
 import databases
 import sqlalchemy
+import hashlib
+import hmac
 import os
-
-app = FastAPI(title="EcoFlow Project Service")
+import time
+
+app = FastAPI(title="EcoFlow Project Service", default_response_class=ORJSONResponse)
+
+# Проверка подписи внутренних запросов от api-gateway
+INTERNAL_SECRET = os.getenv("INTERNAL_SECRET", "ecoflow-internal-secret").encode()
+INTERNAL_AUTH_MAX_AGE = 30  # секунд
+
+async def verify_internal_auth(
+    x_user_id: int = Header(...),
+    x_ts: int = Header(...),
+    x_internal_auth: str = Header(...)
+) -> int:
+    """Проверка подписи gateway, возвращает id пользователя"""
+    if abs(time.time() - x_ts) > INTERNAL_AUTH_MAX_AGE:
+        raise HTTPException(status_code=401, detail="Internal auth expired")
+    expected = hmac.new(INTERNAL_SECRET, f"{x_user_id}:{x_ts}".encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, x_internal_auth):
+        raise HTTPException(status_code=401, detail="Invalid internal auth")
+    return x_user_id
+
+def check_user_access(user_id: int, x_user_id: int):
+    if user_id != x_user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
 
 # Настройки базы данных
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./projects.db")
@@ -57,11 +82,55 @@ project_members = sqlalchemy.Table(
     sqlalchemy.Column("user_id", sqlalchemy.Integer),
     sqlalchemy.Column("role", sqlalchemy.String(50)),
     sqlalchemy.Column("joined_at", sqlalchemy.DateTime, default=datetime.utcnow),
+    sqlalchemy.Index("ix_pm_user", "user_id", "project_id"),
 )
 
 engine = sqlalchemy.create_engine(DATABASE_URL)
+
+if engine.dialect.name == "sqlite":
+    # WAL: читатели не блокируются записью; режим сохраняется в файле БД
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
 metadata.create_all(engine)
 
+# create_all пропускает существующие таблицы вместе с их индексами,
+# поэтому индексы досоздаем отдельно для уже существующих БД
+for table in metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+# Запросы, собранные один раз; значения подставляются через .params()
+PROJECT_BY_ID_QUERY = projects.select().where(projects.c.id == sqlalchemy.bindparam("project_id"))
+
+USER_PROJECTS_QUERY = (
+    projects.select()
+    .join(project_members, projects.c.id == project_members.c.project_id)
+    .where(project_members.c.user_id == sqlalchemy.bindparam("user_id"))
+)
+
+PROJECTS_BY_TYPE_QUERY = projects.select().where(
+    projects.c.project_type == sqlalchemy.bindparam("project_type")
+)
+
+PROJECT_MEMBER_QUERY = project_members.select().where(
+    (project_members.c.project_id == sqlalchemy.bindparam("project_id")) &
+    (project_members.c.user_id == sqlalchemy.bindparam("user_id"))
+)
+
+CO2_REDUCTION_STATS_QUERY = sqlalchemy.text("""
+    SELECT 
+        SUM(co2_reduction_goal) as total_goal,
+        SUM(co2_reduction_goal * current_progress / 100) as achieved,
+        project_type,
+        COUNT(*) as project_count
+    FROM projects
+    GROUP BY project_type
+""")
+
 # Модели
 class ProjectCreate(BaseModel):
     name: str = Field(..., min_length=3, max_length=200)
@@ -103,32 +172,29 @@ async def health():
     return {"status": "healthy", "service": "project-service"}
 
 @app.post("/projects", response_model=ProjectResponse)
-async def create_project(project: ProjectCreate, x_user_id: int = Query(...)):
-    query = projects.insert().values(
-        **project.dict(),
-        created_by=x_user_id,
-        status=ProjectStatus.PLANNING
-    )
-    project_id = await database.execute(query)
-    
-    # Добавляем создателя как участника
-    member_query = project_members.insert().values(
-        project_id=project_id,
-        user_id=x_user_id,
-        role="creator"
-    )
-    await database.execute(member_query)
-    
-    # Получаем созданный проект
-    query = projects.select().where(projects.c.id == project_id)
-    created_project = await database.fetch_one(query)
+async def create_project(project: ProjectCreate, x_user_id: int = Depends(verify_internal_auth)):
+    async with database.transaction():
+        # RETURNING отдает созданную строку, отдельный SELECT не нужен
+        query = projects.insert().values(
+            **project.dict(),
+            created_by=x_user_id,
+            status=ProjectStatus.PLANNING
+        ).returning(*projects.c)
+        created_project = await database.fetch_one(query)
+        
+        # Добавляем создателя как участника
+        member_query = project_members.insert().values(
+            project_id=created_project.id,
+            user_id=x_user_id,
+            role="creator"
+        )
+        await database.execute(member_query)
     
     return created_project
 
 @app.get("/projects/{project_id}", response_model=ProjectResponse)
 async def get_project(project_id: int):
-    query = projects.select().where(projects.c.id == project_id)
-    project = await database.fetch_one(query)
+    project = await database.fetch_one(PROJECT_BY_ID_QUERY.params(project_id=project_id))
     
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
@@ -136,32 +202,26 @@ async def get_project(project_id: int):
     return project
 
 @app.get("/projects/user/{user_id}", response_model=List[ProjectResponse])
-async def get_user_projects(user_id: int):
+async def get_user_projects(user_id: int, x_user_id: int = Depends(verify_internal_auth)):
+    check_user_access(user_id, x_user_id)
+    
     # Получаем проекты, где пользователь является участником
-    query = (
-        projects.select()
-        .join(project_members, projects.c.id == project_members.c.project_id)
-        .where(project_members.c.user_id == user_id)
-    )
-    return await database.fetch_all(query)
+    return await database.fetch_all(USER_PROJECTS_QUERY.params(user_id=user_id))
 
 @app.get("/projects/type/{project_type}", response_model=List[ProjectResponse])
 async def get_projects_by_type(project_type: str):
-    query = projects.select().where(projects.c.project_type == project_type)
-    return await database.fetch_all(query)
+    return await database.fetch_all(PROJECTS_BY_TYPE_QUERY.params(project_type=project_type))
 
 @app.patch("/projects/{project_id}/progress")
 async def update_progress(
     project_id: int,
     progress: float = Field(..., ge=0, le=100),
-    x_user_id: int = Query(...)
+    x_user_id: int = Depends(verify_internal_auth)
 ):
     # Проверяем права доступа
-    query = project_members.select().where(
-        (project_members.c.project_id == project_id) &
-        (project_members.c.user_id == x_user_id)
+    member = await database.fetch_one(
+        PROJECT_MEMBER_QUERY.params(project_id=project_id, user_id=x_user_id)
     )
-    member = await database.fetch_one(query)
     
     if not member:
         raise HTTPException(status_code=403, detail="Not a project member")
@@ -188,13 +248,4 @@ async def update_progress(
 @app.get("/stats/co2-reduction")
 async def get_co2_reduction_stats():
     """Получение статистики по сокращению CO2"""
-    query = sqlalchemy.text("""
-        SELECT 
-            SUM(co2_reduction_goal) as total_goal,
-            SUM(co2_reduction_goal * current_progress / 100) as achieved,
-            project_type,
-            COUNT(*) as project_count
-        FROM projects
-        GROUP BY project_type
-    """)
-    return await database.fetch_all(query)
+    return await database.fetch_all(CO2_REDUCTION_STATS_QUERY)